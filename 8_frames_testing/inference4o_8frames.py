@@ -1,44 +1,82 @@
 import os
+import sys
 import csv
-import base64
 import asyncio
+import hashlib
 import aiohttp
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai import APIConnectionError, BadRequestError, InternalServerError, NotFoundError, RateLimitError
+from tenacity import retry_if_exception_type
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
+import orjson
 from asyncio import Semaphore
 from dotenv import load_dotenv
 
+# Make the shared helpers at the repo root importable when run from this folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import frame_cache
+from progress import completed_video_ids, open_results
+from rate_limit import api_retrying
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MODEL = "gpt-4o"
+
+# Errors worth retrying; APIConnectionError also covers timeouts
+TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
 class AsyncGPT4VProcessor:
-    def __init__(self, api_key: str = "", max_concurrent_requests: int = 5):
+    def __init__(self, api_key: str = "", max_concurrent_requests: int = 5, frame_count: int = 8,
+                 results_path: str = "results.ndjson"):
         """
         Initialize the GPT-4V processor with API credentials
         
         Args:
             api_key (str): OpenAI API key
             max_concurrent_requests (int): Maximum number of concurrent API requests
+            frame_count (int): Number of frames shown per question
+            results_path (str): NDJSON file that results are appended to, one per line
         """
-        self.client = AsyncOpenAI(api_key=api_key)
+        # Pool keep-alive HTTP/2 connections so concurrent requests reuse them;
+        # DefaultAsyncHttpxClient keeps the SDK's own timeout and redirect settings
+        self.http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_concurrent_requests * 2,
+                max_keepalive_connections=max_concurrent_requests * 2
+            )
+        )
+        # Retries are handled by create_response, so the SDK's own are turned off
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
         self.semaphore = Semaphore(max_concurrent_requests)
+        self._prompt_prefix = self.create_prompt_prefix(frame_count)
+        self.out_f = open_results(results_path)
+        # Uploaded files belong to the account the key is for, so file IDs are cached per key;
+        # only a hash of the key goes into the cache
+        self.upload_provider = "openai:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
 
-    def encode_image(self, image_path: str) -> str:
+    def save_result(self, result: Dict):
         """
-        Encode an image file to base64
-        
+        Append a result to the NDJSON results file
+
         Args:
-            image_path (str): Path to the image file
-            
-        Returns:
-            str: Base64 encoded image
+            result (Dict): Result including its video_id
         """
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+        # A single write with no await in between, so concurrent tasks can't interleave lines
+        self.out_f.write(orjson.dumps(result) + b'\n')
+        self.out_f.flush()
+
+    async def close(self):
+        """
+        Close the pooled HTTP connections and the results file
+        """
+        await self.http_client.aclose()
+        self.out_f.close()
 
     def get_frame_paths(self, video_id: str) -> List[str]:
         """
@@ -50,20 +88,76 @@ class AsyncGPT4VProcessor:
         Returns:
             List[str]: List of frame image paths
         """
-        frame_dir = Path('extracted_frames_8') / str(video_id)
-        frame_paths = sorted(list(frame_dir.glob('frame_*.jpg')))
-        return [str(path) for path in frame_paths]
+        frame_dir = os.path.join('extracted_frames_8', str(video_id))
+        try:
+            with os.scandir(frame_dir) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.name.startswith('frame_') and entry.name.endswith('.jpg')
+                    and entry.name[6:-4].isdigit()
+                ]
+        except FileNotFoundError:
+            return []
 
-    def create_prompt(self, question: str, frame_count: int = 8) -> str:
+        # Sort by frame number, so frame_10 comes after frame_9
+        names.sort(key=lambda name: int(name[6:-4]))
+        return [os.path.join(frame_dir, name) for name in names]
+
+    async def upload_frame(self, image_path: str, refresh: bool = False) -> str:
         """
-        Create the prompt for GPT-4V
-        
+        Upload a frame for use as a vision input, reusing an earlier upload if there is one
+
+        Uploads are retried like requests, and each attempt takes its own slot
+        of the concurrency limit.
+
+        Args:
+            image_path (str): Path to the frame image
+            refresh (bool): Upload again even if a file ID is cached, e.g. after the API rejected it
+
+        Returns:
+            str: OpenAI file ID of the uploaded frame
+        """
+        if refresh:
+            frame_cache.delete_upload(self.upload_provider, image_path)
+        file_id = frame_cache.get_upload(self.upload_provider, image_path)
+        if file_id is None:
+            async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+                with attempt:
+                    async with self.semaphore:
+                        image_bytes = await asyncio.to_thread(Path(image_path).read_bytes)
+                        uploaded = await self.client.files.create(
+                            file=(os.path.basename(image_path), image_bytes, "image/jpeg"),
+                            purpose="vision"
+                        )
+            file_id = uploaded.id
+            frame_cache.set_upload(self.upload_provider, image_path, file_id)
+        return file_id
+
+    async def upload_frames(self, frame_paths: List[str], refresh: bool = False) -> List[str]:
+        """
+        Upload all frames of a video concurrently
+
+        Frames uploaded by an earlier run are not sent again, so on re-runs
+        the request only carries file IDs instead of inline base64 images.
+
+        Args:
+            frame_paths (List[str]): Paths to the frame images
+            refresh (bool): Upload every frame again, ignoring cached file IDs
+
+        Returns:
+            List[str]: OpenAI file IDs, in the same order as frame_paths
+        """
+        return await asyncio.gather(*(self.upload_frame(path, refresh) for path in frame_paths))
+
+    def create_prompt_prefix(self, frame_count: int = 8) -> str:
+        """
+        Create the constant part of the prompt for GPT-4V, everything before the question
+
         Args:
-            question (str): The question to answer
             frame_count (int): Number of frames
-            
+
         Returns:
-            str: Formatted prompt
+            str: Prompt text that precedes the question
         """
         return f"""I am showing you {frame_count} equally spaced frames from a 5-second video. 
 The frames are numbered 1 through {frame_count} in chronological order.
@@ -72,9 +166,79 @@ all that reasoning together to choose the best answer from the multiple choice o
 important than others when it comes to answering the question. Make sure at the end of your answer you 
 output the best answer letter choice in <answer></answer> tags. Here is the multiple choice question:
 
-{question}
 """
 
+    def create_prompt(self, question: str) -> str:
+        """
+        Create the prompt for GPT-4V
+
+        Args:
+            question (str): The question to answer
+
+        Returns:
+            str: Formatted prompt
+        """
+        return self._prompt_prefix + question + "\n"
+
+    def build_content(self, question: str, file_ids: List[str]) -> List[Dict]:
+        """
+        Build the content parts of the user message: the prompt, then every frame
+
+        Args:
+            question (str): The question to answer
+            file_ids (List[str]): OpenAI file IDs of the frames, in order
+
+        Returns:
+            List[Dict]: Content parts of the user message
+        """
+        # Prepare the content list with the initial text prompt
+        content = [
+            {
+                "type": "input_text",
+                "text": self.create_prompt(question)
+            }
+        ]
+
+        # Add each frame as a reference to its uploaded file
+        for file_id in file_ids:
+            content.append({
+                "type": "input_image",
+                "file_id": file_id,
+                "detail": "auto"
+            })
+
+        return content
+
+    async def create_response(self, content: List[Dict]):
+        """
+        Send a request to the model, retrying with exponential backoff on rate limits and transient errors
+
+        Each attempt takes its own slot of the concurrency limit, so a request
+        waiting out its backoff doesn't keep other requests from being sent.
+
+        Args:
+            content (List[Dict]): Content parts of the user message
+
+        Returns:
+            Response: API response
+        """
+        async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+            with attempt:
+                async with self.semaphore:  # Limit concurrent requests
+                    response = await self.client.responses.create(
+                        model=MODEL,
+                        input=[
+                            {
+                                "role": "user",
+                                "content": content
+                            }
+                        ],
+                        max_output_tokens=4096,
+                        temperature=0,
+                        top_p=0
+                    )
+        return response
+
     async def process_question(self, video_id: str, question: str) -> Dict:
         """
         Process a single question with its associated frames
@@ -86,61 +250,55 @@ output the best answer letter choice in <answer></answer> tags. Here is the mult
         Returns:
             Dict: API response
         """
-        async with self.semaphore:  # Limit concurrent requests
+        try:
+            # Get frame paths
+            frame_paths = self.get_frame_paths(video_id)
+            
+            if not frame_paths:
+                raise FileNotFoundError(f"No frames found for video ID {video_id}")
+
+            # Make API request, with each frame as a reference to its uploaded file
+            file_ids = await self.upload_frames(frame_paths)
             try:
-                # Get frame paths
-                frame_paths = self.get_frame_paths(video_id)
-                
-                if not frame_paths:
-                    raise FileNotFoundError(f"No frames found for video ID {video_id}")
-
-                # Prepare the content list with the initial text prompt
-                content = [
-                    {
-                        "type": "text",
-                        "text": self.create_prompt(question)
-                    }
-                ]
-                
-                # Add each frame as an image_url
-                for path in frame_paths:
-                    base64_image = self.encode_image(path)
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    })
-
-                # Make API request
-                completion = await self.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": content
-                        }
-                    ],
-                    max_tokens=4096,
-                    temperature=0,
-                    top_p=0
-                )
-                
-                # Extract the response content
-                response = {
-                    "video_id": video_id,
-                    "answer": completion.choices[0].message.content,
-                    "finish_reason": completion.choices[0].finish_reason,
-                }
-                
-                return response
-
-            except Exception as e:
-                logger.error(f"Error processing video ID {video_id}: {str(e)}")
-                return {
-                    "video_id": video_id,
-                    "error": str(e)
-                }
+                completion = await self.create_response(self.build_content(question, file_ids))
+            except (BadRequestError, NotFoundError):
+                # A cached file ID may have been deleted on OpenAI's side; upload the
+                # frames again and retry once before giving up on the question
+                logger.warning(f"Request for video ID {video_id} was rejected; re-uploading its frames")
+                file_ids = await self.upload_frames(frame_paths, refresh=True)
+                completion = await self.create_response(self.build_content(question, file_ids))
+            
+            # Extract the response content
+            response = {
+                "video_id": video_id,
+                "answer": completion.output_text,
+                "finish_reason": completion.incomplete_details.reason if completion.incomplete_details else "stop",
+            }
+            
+            return response
+
+        except Exception as e:
+            logger.error(f"Error processing video ID {video_id}: {str(e)}")
+            return {
+                "video_id": video_id,
+                "error": str(e)
+            }
+
+    async def process_and_save(self, q: Dict) -> Dict:
+        """
+        Process a single question and save its result as soon as it completes
+
+        Args:
+            q (Dict): Dictionary containing video_id and question
+
+        Returns:
+            Dict: API response
+        """
+        result = await self.process_question(q['id'], q['question'])
+        self.save_result(result)
+
+        logger.info(f"Completed processing video ID: {q['id']}")
+        return result
 
     async def process_batch(self, questions: List[Dict]) -> List[Dict]:
         """
@@ -154,7 +312,7 @@ output the best answer letter choice in <answer></answer> tags. Here is the mult
         """
         tasks = []
         for q in questions:
-            task = self.process_question(q['id'], q['question'])
+            task = self.process_and_save(q)
             tasks.append(task)
         
         return await asyncio.gather(*tasks)
@@ -168,32 +326,34 @@ async def main():
     if not api_key:
         raise ValueError("OPENAI_API_KEY_KOA_4o environment variable not set")
 
-    # Initialize processor with concurrent request limit
-    processor = AsyncGPT4VProcessor(api_key, max_concurrent_requests=5)
-
     # Create output directory for results
     output_dir = Path('gpt4v_results_8frames')
     output_dir.mkdir(exist_ok=True)
 
-    # Read all questions from CSV
+    # Results of earlier runs are kept, so only unfinished questions are sent again
+    results_path = output_dir / 'results.ndjson'
+    done = completed_video_ids(results_path)
+
+    # Initialize processor with concurrent request limit
+    processor = AsyncGPT4VProcessor(
+        api_key,
+        max_concurrent_requests=5,
+        results_path=results_path
+    )
+
+    # Read all questions from CSV, skipping those already answered
     questions = []
     with open('questions.csv', 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         questions = list(reader)
+    questions = [q for q in questions if q['id'] not in done]
 
     # Process questions in parallel
-    logger.info(f"Processing {len(questions)} questions in parallel...")
-    results = await processor.process_batch(questions)
-
-    # Save results
-    for result in results:
-        video_id = result.pop('video_id')  # Remove video_id before saving
-        output_path = output_dir / f"{video_id}_result.json"
-        
-        with open(output_path, 'w') as f:
-            json.dump(result, f, indent=2)
-        
-        logger.info(f"Completed processing video ID: {video_id}")
+    logger.info(f"Processing {len(questions)} questions in parallel ({len(done)} already done)...")
+    try:
+        await processor.process_batch(questions)  # Results are saved as they complete
+    finally:
+        await processor.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
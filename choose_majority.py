@@ -1,5 +1,4 @@
 import pandas as pd
-from collections import Counter
 
 def find_majority_answers(csv_files):
     """
@@ -11,8 +10,8 @@ def find_majority_answers(csv_files):
     Returns:
         pandas.DataFrame: DataFrame with ID and majority answer
     """
-    # Dictionary to store answers for each ID
-    all_answers = {}
+    # Collect the id/answer columns of every readable file
+    dfs = []
     
     # Process each CSV file
     for file in csv_files:
@@ -25,45 +24,29 @@ def find_majority_answers(csv_files):
                 print(f"Error: Required columns missing in {file}")
                 continue
                 
-            # Process each row
-            for _, row in df.iterrows():
-                id_num = row['id']
-                answer = row['answer']
-                
-                # Initialize list for this ID if it doesn't exist
-                if id_num not in all_answers:
-                    all_answers[id_num] = []
-                    
-                # Add this answer to the list for this ID
-                all_answers[id_num].append(answer)
+            dfs.append(df[['id', 'answer']])
                 
         except Exception as e:
             print(f"Error processing file {file}: {str(e)}")
             continue
     
-    # Calculate majority answer for each ID
-    majority_results = []
-    for id_num, answers in all_answers.items():
-        # Find the most common answer
-        if answers:
-            # Count occurrences of each answer
-            counter = Counter(answers)
-            max_count = max(counter.values())
-            
-            # Get all answers that appear the maximum number of times
-            max_answers = [ans for ans, count in counter.items() if count == max_count]
-            
-            # If there's a tie, use the alphabetically first answer
-            majority_answer = min(max_answers)
-            
-            majority_results.append({
-                'id': id_num,
-                'answer': majority_answer
-            })
+    if not dfs:
+        return pd.DataFrame(columns=['id', 'answer'])
+    
+    all_df = pd.concat(dfs, ignore_index=True)
+    
+    # Most common answer per ID; sorting the counts by answer first means a tie
+    # is won by the alphabetically first answer. groupby already sorts by ID.
+    # value_counts drops blanks, so an ID with no answer in any file gets NaN.
+    def majority(answers):
+        counts = answers.value_counts().sort_index()
+        return counts.idxmax() if len(counts) else pd.NA
     
-    # Convert results to DataFrame and sort by ID
-    result_df = pd.DataFrame(majority_results)
-    result_df = result_df.sort_values('id')
+    result_df = (
+        all_df.groupby('id')['answer']
+        .agg(majority)
+        .reset_index()
+    )
     
     return result_df
 
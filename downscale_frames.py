@@ -0,0 +1,81 @@
+from pathlib import Path
+from PIL import Image
+
+# libvips decodes and resizes JPEGs several times faster than Pillow; use it when installed
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# Longest side the models actually look at; they downsample anything larger themselves
+MAX_SIZE = 768
+JPEG_QUALITY = 80
+
+def downscale_with_pyvips(frame_path: Path) -> bool:
+    """
+    Shrink one frame in place with libvips
+
+    Args:
+        frame_path (Path): Path to the frame image
+
+    Returns:
+        bool: True if the frame was resized, False if it was already small enough
+    """
+    # Only reads the header, so checking the size is cheap
+    header = pyvips.Image.new_from_file(str(frame_path))
+    if max(header.width, header.height) <= MAX_SIZE:
+        return False
+
+    # thumbnail uses JPEG shrink-on-load, so the full-size image is never decoded
+    image = pyvips.Image.thumbnail(str(frame_path), MAX_SIZE, size='down')
+    data = image.jpegsave_buffer(Q=JPEG_QUALITY, optimize_coding=True, interlace=True, strip=True)
+    frame_path.write_bytes(data)
+    return True
+
+def downscale_with_pillow(frame_path: Path) -> bool:
+    """
+    Shrink one frame in place with Pillow
+
+    Args:
+        frame_path (Path): Path to the frame image
+
+    Returns:
+        bool: True if the frame was resized, False if it was already small enough
+    """
+    with Image.open(frame_path) as image:
+        if max(image.size) <= MAX_SIZE:
+            return False
+
+        # Keeps the aspect ratio; draft lets libjpeg decode at a reduced scale
+        image.draft('RGB', (MAX_SIZE, MAX_SIZE))
+        image.thumbnail((MAX_SIZE, MAX_SIZE))
+        image.save(frame_path, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return True
+
+def downscale_frames(frames_dir):
+    """
+    Shrink every extracted frame in place so requests carry less image data.
+
+    Frames already within MAX_SIZE are left alone, so this is safe to re-run
+    after extracting new videos.
+
+    Args:
+        frames_dir (str): Path to the directory of per-video frame folders
+    """
+    downscale = downscale_with_pyvips if pyvips is not None else downscale_with_pillow
+    frame_paths = sorted(Path(frames_dir).glob('*/frame_*.jpg'))
+
+    resized = 0
+    for frame_path in frame_paths:
+        try:
+            if downscale(frame_path):
+                resized += 1
+
+        except Exception as e:
+            print(f"Error processing {frame_path}: {str(e)}")
+
+    print(f"Downscaled {resized} of {len(frame_paths)} frames")
+
+if __name__ == "__main__":
+    frames_directory = "extracted_frames"  # Change this if your frames are in a different directory
+    downscale_frames(frames_directory)
@@ -1,27 +1,49 @@
-import json
+import orjson
 import os
 import re
 import csv
 from pathlib import Path
+from typing import Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+# Matches both "<answer>C</answer>" and answers with trailing content such as "<answer>C. 27</answer>"
+_ANS_RE = re.compile(r'<answer>\s*([A-E])(?:[.\s][^<]*)?</answer>')
 
 def extract_answer_from_json(json_content):
     """Extract the letter from <answer> tags, handling both simple letter and letter with additional content."""
     answer_text = json_content.get('answer', '')
     
-    # First try to match the pattern with additional content (e.g., "C. 27")
-    match = re.search(r'<answer>([A-E])[.\s].*?</answer>', answer_text)
-    if match:
-        return match.group(1)
-    
-    # If no match, try to match just the letter
-    match = re.search(r'<answer>([A-E])</answer>', answer_text)
-    if match:
-        return match.group(1)
-    
-    return None
+    match = _ANS_RE.search(answer_text)
+    return match.group(1) if match else None
+
+def load_ndjson_results(ndjson_path):
+    """Load results from an NDJSON file keyed by zero-padded ID, keeping the latest successful record per ID."""
+    records = {}
+    with open(ndjson_path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Left partly written by a run that was killed mid-write
+                print(f"Warning: Skipping undecodable line {line_number} in {ndjson_path}")
+                continue
+            file_id = str(record['video_id']).zfill(5)
+            # Re-runs append to the same file; don't let a later error hide an earlier answer
+            if 'error' not in record or file_id not in records:
+                records[file_id] = record
+    return records
+
+def parse_one(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """Read one result file and extract its answer, returning (answer, error). Runs in a worker process."""
+    try:
+        return extract_answer_from_json(orjson.loads(Path(path).read_bytes())), None
+    except Exception as e:
+        return None, str(e)
 
 def process_files(folder_path):
-    """Process all JSON files in the folder and create a CSV with results."""
+    """Process all JSON files in the folder (or the records of a results.ndjson file) and create a CSV with results."""
     # Create a list to store results
     results = []
     
@@ -30,40 +52,56 @@ def process_files(folder_path):
         file_id = str(id_num).zfill(5)
         results.append([file_id, 'X'])
     
-    # Get all JSON files in the folder
+    # Get all JSON files in the folder, or all records of an NDJSON results file,
+    # as (file_id, source, record) where record is None until the file is read
     folder = Path(folder_path)
-    json_files = sorted(folder.glob('*.json'))
+    if folder.suffix == '.ndjson':
+        entries = [
+            (file_id, f"{folder} (ID {file_id})", record)
+            for file_id, record in sorted(load_ndjson_results(folder).items())
+        ]
+    else:
+        # Extract ID from filename (00001 from 00001_result.json)
+        entries = [
+            (json_file.name.split('_')[0], json_file, None)
+            for json_file in sorted(folder.glob('*.json'))
+        ]
     
     # Keep track of processed IDs
     processed_ids = set()
     
-    # Process each file (only for IDs 51-251)
-    for json_file in json_files:
-        # Extract ID from filename (00001 from 00001_result.json)
-        file_id = json_file.name.split('_')[0]
-        
-        # Check if ID is within our range (51 to 251)
+    # Keep only IDs within our range (51 to 251)
+    in_range = []
+    for file_id, json_file, record in entries:
         try:
-            id_num = int(file_id)
-            if 51 <= id_num <= 251:
-                # Read and parse JSON file
-                try:
-                    with open(json_file, 'r', encoding='utf-8') as f:
-                        json_content = json.load(f)
-                        
-                    # Extract answer
-                    answer = extract_answer_from_json(json_content)
-                    if answer:
-                        results.append([file_id, answer])
-                        processed_ids.add(id_num)
-                    else:
-                        print(f"Warning: No answer found in {json_file}")
-                        
-                except Exception as e:
-                    print(f"Error processing {json_file}: {str(e)}")
+            if 51 <= int(file_id) <= 251:
+                in_range.append((file_id, json_file, record))
         except ValueError:
             print(f"Warning: Invalid ID format in filename {json_file}")
     
+    # Read and parse the JSON files across all cores; JSON parsing and regex matching
+    # both hold the GIL, so this needs processes rather than threads
+    to_read = [str(json_file) for _, json_file, record in in_range if record is None]
+    parsed = {}
+    if to_read:
+        with ProcessPoolExecutor() as executor:
+            parsed = dict(zip(to_read, executor.map(parse_one, to_read, chunksize=16)))
+    
+    # Process each file
+    for file_id, json_file, record in in_range:
+        if record is not None:
+            answer, error = extract_answer_from_json(record), None
+        else:
+            answer, error = parsed[str(json_file)]
+            
+        if error:
+            print(f"Error processing {json_file}: {error}")
+        elif answer:
+            results.append([file_id, answer])
+            processed_ids.add(int(file_id))
+        else:
+            print(f"Warning: No answer found in {json_file}")
+    
     # Sort all results by ID
     results.sort(key=lambda x: int(x[0]))
     
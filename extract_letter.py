@@ -1,27 +1,53 @@
-import json
+import orjson
 import os
 import asyncio
 import aiohttp
 import aiofiles
 from typing import Optional
 from dotenv import load_dotenv
+from extract_answers import extract_answer_from_json
 
-async def process_single_file(file_path: str, session: aiohttp.ClientSession) -> Optional[tuple[str, str]]:
+# Number of answer texts sent to the model in a single extraction request
+EXTRACTION_BATCH_SIZE = 20
+
+async def save_answer(video_id: str, answer: str):
     """
-    Process a single JSON file and extract the answer choice using OpenAI API.
+    Write an extracted answer to the output directory.
+    
+    Args:
+        video_id: ID the answer belongs to
+        answer: Answer in <answer></answer> tags
+    """
+    # Create output directory if it doesn't exist
+    output_dir = "gemini_pro_final_answers"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Write result to output file
+    output_path = os.path.join(output_dir, f"{video_id}_result.json")
+    async with aiofiles.open(output_path, 'wb') as f:
+        await f.write(orjson.dumps({"answer": answer}, option=orjson.OPT_INDENT_2))
+    
+    print(f"Processed {video_id}: {answer}")
+
+async def process_single_file(file_path: str) -> Optional[tuple[str, str, Optional[str]]]:
+    """
+    Load a single JSON file and extract the answer choice locally when it is already tagged.
+    
+    Answers that already contain <answer>X</answer> are saved straight away;
+    only the rest need to be sent to the OpenAI API.
     
     Args:
         file_path: Path to the JSON file
-        session: aiohttp ClientSession for making API calls
         
     Returns:
-        Tuple of (filename, answer) if successful, None if failed
+        Tuple of (video_id, answer_text, answer) if successful, where answer is None
+        when it could not be extracted locally. None if failed
     """
     try:
         # Read the JSON file asynchronously
-        async with aiofiles.open(file_path, 'r') as f:
+        async with aiofiles.open(file_path, 'rb') as f:
             content = await f.read()
-            data = json.loads(content)
+            data = orjson.loads(content)
             
         # Extract the answer text
         answer_text = data.get('answer', '')
@@ -29,6 +55,41 @@ async def process_single_file(file_path: str, session: aiohttp.ClientSession) ->
             print(f"Warning: No answer found in {file_path}")
             return None
             
+        # Get video ID from filename
+        video_id = os.path.splitext(os.path.basename(file_path))[0]
+        
+        # Skip the API call when the answer is already tagged
+        letter = extract_answer_from_json(data)
+        if letter:
+            answer = f"<answer>{letter}</answer>"
+            await save_answer(video_id, answer)
+            return (video_id, answer_text, answer)
+            
+        return (video_id, answer_text, None)
+        
+    except Exception as e:
+        print(f"Error processing {file_path}: {str(e)}")
+        return None
+
+async def process_batch(batch: list[tuple[str, str]], session: aiohttp.ClientSession) -> list[tuple[str, str]]:
+    """
+    Extract the answer choices for a batch of answer texts with a single OpenAI API call.
+    
+    Args:
+        batch: List of (video_id, answer_text) tuples
+        session: aiohttp ClientSession for making API calls
+        
+    Returns:
+        List of (video_id, answer) tuples for every answer that was extracted
+    """
+    try:
+        # Number the answers so the model's output can be mapped back to the files. The texts
+        # often contain numbered lists of their own, so each one is wrapped in a tag carrying
+        # its number rather than prefixed with "N)"
+        numbered_answers = "\n\n".join(
+            f'<text id="{i}">\n{answer_text}\n</text>' for i, (_, answer_text) in enumerate(batch, 1)
+        )
+        
         # Create the API call to GPT-4
         headers = {
             "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY_KOA_4o')}",
@@ -40,15 +101,16 @@ async def process_single_file(file_path: str, session: aiohttp.ClientSession) ->
             "messages": [
                 {
                     "role": "system",
-                    "content": "Extract the letter choice (A, B, C, D, or E) that is indicated as the answer in the text. Output the answer in tags like this: <answer>B</answer>"
+                    "content": "You will be given texts, each wrapped in <text id=\"N\"></text> tags. For each text, extract the letter choice (A, B, C, D, or E) that is indicated as the answer. Output JSON with one item per text, where i is the text's id, like this: {\"answers\": [{\"i\": 1, \"a\": \"B\"}, {\"i\": 2, \"a\": \"D\"}]}"
                 },
                 {
                     "role": "user",
-                    "content": answer_text
+                    "content": f"Extract letters for:\n{numbered_answers}"
                 }
             ],
+            "response_format": {"type": "json_object"},
             "temperature": 0,
-            "max_tokens": 50
+            "max_tokens": 20 * len(batch) + 50
         }
         
         async with session.post(
@@ -58,34 +120,47 @@ async def process_single_file(file_path: str, session: aiohttp.ClientSession) ->
         ) as response:
             if response.status != 200:
                 error_text = await response.text()
-                print(f"API error for {file_path}: {error_text}")
-                return None
+                print(f"API error for batch starting at {batch[0][0]}: {error_text}")
+                return []
                 
             result = await response.json()
-            answer = result['choices'][0]['message']['content'].strip()
+            extracted = orjson.loads(result['choices'][0]['message']['content'])
+            # The model may return numbers as strings or letters in lower case
+            items = extracted.get('answers', [])
+            letters = {}
+            for item in items:
+                try:
+                    letters[int(item['i'])] = str(item['a']).strip().upper()
+                except (KeyError, TypeError, ValueError):
+                    print(f"Warning: Malformed item {item!r} in batch starting at {batch[0][0]}")
             
-            # Get video ID from filename
-            video_id = os.path.splitext(os.path.basename(file_path))[0]
+            # A missing, repeated or out-of-range id means the answers may be shifted onto the
+            # wrong texts, which would save valid-looking letters to the wrong files
+            if len(items) != len(batch) or set(letters) != set(range(1, len(batch) + 1)):
+                print(f"Error: Answer ids don't match the {len(batch)} texts in batch starting at {batch[0][0]}; skipping batch")
+                return []
             
-            # Create output directory if it doesn't exist
-            output_dir = "gemini_pro_final_answers"
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Write result to output file
-            output_path = os.path.join(output_dir, f"{video_id}_result.json")
-            async with aiofiles.open(output_path, 'w') as f:
-                await f.write(json.dumps({"answer": answer}, indent=2))
+        results = []
+        for i, (video_id, _) in enumerate(batch, 1):
+            letter = letters.get(i)
+            if letter not in ('A', 'B', 'C', 'D', 'E'):
+                print(f"Warning: No answer extracted for {video_id}")
+                continue
+                
+            # Keep the tagged format that extract_answers.py parses
+            answer = f"<answer>{letter}</answer>"
+            await save_answer(video_id, answer)
+            results.append((video_id, answer))
             
-            print(f"Processed {video_id}: {answer}")
-            return (video_id, answer)
+        return results
         
     except Exception as e:
-        print(f"Error processing {file_path}: {str(e)}")
-        return None
+        print(f"Error processing batch starting at {batch[0][0]}: {str(e)}")
+        return []
 
 async def process_all_files(directory: str):
     """
-    Process all JSON files in the directory concurrently.
+    Process all JSON files in the directory, extracting answers in batches.
     
     Args:
         directory: Directory containing JSON files
@@ -97,24 +172,41 @@ async def process_all_files(directory: str):
         if f.endswith('.json')
     ]
     
+    # Load every answer text up front, extracting tagged answers locally
+    loaded = await asyncio.gather(*(process_single_file(file_path) for file_path in json_files))
+    loaded = [item for item in loaded if item is not None]
+    extracted_locally = [(video_id, answer) for video_id, _, answer in loaded if answer]
+    answers = [(video_id, answer_text) for video_id, answer_text, answer in loaded if not answer]
+    print(f"Extracted {len(extracted_locally)} answers locally, {len(answers)} need the API")
+    
+    # Group the answers so each API call extracts many of them at once
+    batches = [
+        answers[i:i + EXTRACTION_BATCH_SIZE]
+        for i in range(0, len(answers), EXTRACTION_BATCH_SIZE)
+    ]
+    
     # Configure rate limiting
     semaphore = asyncio.Semaphore(10)  # Limit concurrent API calls
     
-    async def process_with_semaphore(file_path: str, session: aiohttp.ClientSession):
+    async def process_with_semaphore(batch: list[tuple[str, str]], session: aiohttp.ClientSession):
         async with semaphore:
-            return await process_single_file(file_path, session)
+            return await process_batch(batch, session)
+    
+    # Keep connections alive and reuse them across batches instead of paying a
+    # new TCP + TLS handshake for each request
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=50, keepalive_timeout=75, ttl_dns_cache=300)
     
-    # Process files concurrently
-    async with aiohttp.ClientSession() as session:
+    # Process batches concurrently
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
         tasks = [
-            process_with_semaphore(file_path, session)
-            for file_path in json_files
+            process_with_semaphore(batch, session)
+            for batch in batches
         ]
         results = await asyncio.gather(*tasks)
     
     # Count successful processes
-    successful = len([r for r in results if r is not None])
-    print(f"\nProcessed {successful} files successfully")
+    successful = len(extracted_locally) + sum(len(r) for r in results)
+    print(f"\nProcessed {successful} files successfully in {len(batches)} requests")
     print(f"Results saved to {os.path.abspath('gemini_video_final_answers')} directory")
 
 async def main():
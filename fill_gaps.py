@@ -5,7 +5,7 @@ from openai import OpenAI
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
+import orjson
 from typing import Optional, Set
 
 # Set up logging
@@ -162,8 +162,8 @@ def main():
 
             if result:
                 output_path = output_dir / f"{video_id}_result.json"
-                with open(output_path, 'w') as f:
-                    json.dump(result, f, indent=2)
+                with open(output_path, 'wb') as f:
+                    f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
 
                 logger.info(f"Completed processing video ID: {video_id}")
 
@@ -0,0 +1,104 @@
+import os
+import base64
+from pathlib import Path
+from typing import Optional, Tuple
+import diskcache
+
+# Frames under extracted_frames*/ never change once extracted, so anything
+# derived from them can be kept on disk and reused across runs and scripts.
+# Anchored at the repo root so scripts run from their own folders share it.
+CACHE_DIR = Path(__file__).resolve().parent / '.cache' / 'frames'
+
+# Read size for streaming base64 encoding; a multiple of 3 so no chunk but the last is padded
+B64_CHUNK_SIZE = 3 * 64 * 1024
+
+_cache = diskcache.Cache(CACHE_DIR)
+
+def frame_key(kind: str, image_path: str) -> Tuple:
+    """
+    Build the cache key for a frame
+
+    The file's mtime and size are part of the key, so re-extracting a video's
+    frames invalidates whatever was cached for them.
+
+    Args:
+        kind (str): What is cached for the frame (e.g. "b64url", "upload:openai")
+        image_path (str): Path to the frame image
+
+    Returns:
+        Tuple: Cache key
+    """
+    st = os.stat(image_path)
+    return (kind, os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+
+def encode_image_b64url(image_path: str) -> str:
+    """
+    Encode an image file to a base64 data URL
+
+    The file is read in chunks whose size is a multiple of 3, so each
+    chunk encodes without padding and is appended straight onto the
+    data URL prefix instead of building several full-size copies.
+
+    Args:
+        image_path (str): Path to the image file
+
+    Returns:
+        str: data:image/jpeg;base64 URL of the image
+    """
+    out = bytearray(b"data:image/jpeg;base64,")
+    with open(image_path, "rb") as image_file:
+        while chunk := image_file.read(B64_CHUNK_SIZE):
+            out += base64.b64encode(chunk)
+    return out.decode("ascii")
+
+def get_data_url(image_path: str) -> str:
+    """
+    Get the base64 data URL for a frame, encoding it only on a cache miss
+
+    Args:
+        image_path (str): Path to the frame image
+
+    Returns:
+        str: data:image/jpeg;base64 URL of the frame
+    """
+    key = frame_key("b64url", image_path)
+    url = _cache.get(key)
+    if url is None:
+        url = encode_image_b64url(image_path)
+        _cache.set(key, url, expire=None)
+    return url
+
+def get_upload(provider: str, image_path: str) -> Optional[str]:
+    """
+    Look up the reference to a frame previously uploaded to a provider
+
+    Args:
+        provider (str): Provider the frame was uploaded to (e.g. "openai", "gemini")
+        image_path (str): Path to the frame image
+
+    Returns:
+        Optional[str]: File ID or URI of the uploaded frame, None if not uploaded yet
+    """
+    return _cache.get(frame_key(f"upload:{provider}", image_path))
+
+def set_upload(provider: str, image_path: str, ref: str, expire: Optional[float] = None):
+    """
+    Remember the reference to a frame uploaded to a provider
+
+    Args:
+        provider (str): Provider the frame was uploaded to (e.g. "openai", "gemini")
+        image_path (str): Path to the frame image
+        ref (str): File ID or URI returned by the upload
+        expire (Optional[float]): Seconds until the provider deletes the upload, None if it is kept
+    """
+    _cache.set(frame_key(f"upload:{provider}", image_path), ref, expire=expire)
+
+def delete_upload(provider: str, image_path: str):
+    """
+    Forget the reference to a frame uploaded to a provider, e.g. after the provider rejected it
+
+    Args:
+        provider (str): Provider the frame was uploaded to (e.g. "openai", "gemini")
+        image_path (str): Path to the frame image
+    """
+    _cache.delete(frame_key(f"upload:{provider}", image_path))
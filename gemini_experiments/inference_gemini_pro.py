@@ -1,41 +1,111 @@
 import os
+import sys
 import csv
+import asyncio
+import httpx
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
+import orjson
+from asyncio import Semaphore
 from google import genai
-from google.genai import types
-import PIL.Image
+from google.genai import errors, types
+from tenacity import retry_if_exception
 from google.generativeai import GenerationConfig
+
+# Make the shared helpers at the repo root importable when run from this folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import frame_cache
+from progress import completed_video_ids, open_results
+from rate_limit import api_retrying
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Files uploaded to the Gemini API are deleted after 48 hours; forget them a little earlier
+GEMINI_FILE_TTL = 47 * 60 * 60
+
+MODEL = 'gemini-2.0-pro-exp-02-05'
+
+def is_transient_error(e: BaseException) -> bool:
+    """Rate limits, server-side failures, timeouts and dropped connections are worth retrying; other errors are not"""
+    # google-genai raises timeouts and connection errors straight from httpx
+    return (
+        isinstance(e, (errors.ServerError, httpx.TransportError))
+        or (isinstance(e, errors.ClientError) and e.code == 429)
+    )
+
 class GeminiFlashProcessor:
-    def __init__(self, api_key: str = ""):
+    def __init__(self, api_key: str = "", max_concurrent_requests: int = 10, frame_count: int = 5,
+                 upload_frames: bool = True, results_path: str = "results.ndjson"):
         """
         Initialize the Gemini Flash processor with API credentials
 
         Args:
             api_key (str): Google API key
+            max_concurrent_requests (int): Maximum number of concurrent API requests
+            frame_count (int): Number of frames shown per question
+            upload_frames (bool): Upload frames once and reference them by URI instead of sending them inline
+            results_path (str): NDJSON file that results are appended to, one per line
         """
         self.client = genai.Client(
             api_key=api_key,
             http_options={'api_version': 'v1alpha'}
         )
+        self.semaphore = Semaphore(max_concurrent_requests)
+        self._prompt_prefix = self.create_prompt_prefix(frame_count)
+        self.upload_frames = upload_frames
+        self.out_f = open_results(results_path)
+
+    def save_result(self, result: Dict):
+        """
+        Append a result to the NDJSON results file
+
+        Args:
+            result (Dict): Result including its video_id
+        """
+        # A single write with no await in between, so concurrent tasks can't interleave lines
+        self.out_f.write(orjson.dumps(result) + b'\n')
+        self.out_f.flush()
+
+    def close(self):
+        """
+        Close the results file
+        """
+        self.out_f.close()
+
+    def load_frame(self, image_path: str) -> types.Part:
+        """
+        Load a frame as an inline JPEG part
+
+        The raw JPEG bytes are handed to the SDK as they are, so the frame is
+        never decoded and re-encoded on the way to the API.
+
+        Args:
+            image_path (str): Path to the image file
 
-    def load_frame(self, image_path: str) -> PIL.Image.Image:
+        Returns:
+            types.Part: Part holding the frame's JPEG bytes
         """
-        Load an image file using PIL
+        return types.Part.from_bytes(data=Path(image_path).read_bytes(), mime_type='image/jpeg')
+
+    async def upload_frame(self, image_path: str) -> types.Part:
+        """
+        Upload a frame to the Gemini Files API, reusing an earlier upload while it is still live
 
         Args:
             image_path (str): Path to the image file
 
         Returns:
-            PIL.Image.Image: PIL Image object
+            types.Part: Part referencing the uploaded frame
         """
-        return PIL.Image.open(image_path)
+        uri = frame_cache.get_upload("gemini", image_path)
+        if uri is None:
+            uploaded = await asyncio.to_thread(self.client.files.upload, file=image_path)
+            uri = uploaded.uri
+            frame_cache.set_upload("gemini", image_path, uri, expire=GEMINI_FILE_TTL)
+        return types.Part.from_uri(file_uri=uri, mime_type='image/jpeg')
 
     def get_frame_paths(self, video_id: str) -> List[str]:
         """
@@ -47,20 +117,30 @@ class GeminiFlashProcessor:
         Returns:
             List[str]: List of frame image paths
         """
-        frame_dir = Path('extracted_frames') / str(video_id)
-        frame_paths = sorted(list(frame_dir.glob('frame_*.jpg')))
-        return [str(path) for path in frame_paths]
+        frame_dir = os.path.join('extracted_frames', str(video_id))
+        try:
+            with os.scandir(frame_dir) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.name.startswith('frame_') and entry.name.endswith('.jpg')
+                    and entry.name[6:-4].isdigit()
+                ]
+        except FileNotFoundError:
+            return []
+
+        # Sort by frame number, so frame_10 comes after frame_9
+        names.sort(key=lambda name: int(name[6:-4]))
+        return [os.path.join(frame_dir, name) for name in names]
 
-    def create_prompt(self, question: str, frame_count: int = 5) -> str:
+    def create_prompt_prefix(self, frame_count: int = 5) -> str:
         """
-        Create the prompt for Gemini
+        Create the constant part of the prompt for Gemini, everything before the question
 
         Args:
-            question (str): The question to answer
             frame_count (int): Number of frames
 
         Returns:
-            str: Formatted prompt
+            str: Prompt text that precedes the question
         """
         return f"""I am showing you {frame_count} equally spaced frames from a 5-second video. 
 The frames are numbered 1 through {frame_count} in chronological order.
@@ -69,10 +149,48 @@ all that reasoning together to choose the best answer from the multiple choice o
 important than others when it comes to answering the question. Make sure at the end of your answer you 
 output the best answer letter choice in <answer></answer> tags. Here is the multiple choice question:
 
-{question}
 """
 
-    def process_question(self, video_id: str, question: str) -> Dict:
+    def create_prompt(self, question: str) -> str:
+        """
+        Create the prompt for Gemini
+
+        Args:
+            question (str): The question to answer
+
+        Returns:
+            str: Formatted prompt
+        """
+        return self._prompt_prefix + question + "\n"
+
+    async def generate(self, contents: List):
+        """
+        Send a request to the model, retrying with exponential backoff on rate limits and server errors
+
+        Each attempt takes its own slot of the concurrency limit, so a request
+        waiting out its backoff doesn't keep other requests from being sent.
+
+        Args:
+            contents (List): Prompt and frames
+
+        Returns:
+            GenerateContentResponse: API response
+        """
+        async for attempt in api_retrying(retry_if_exception(is_transient_error)):
+            with attempt:
+                async with self.semaphore:  # Limit concurrent requests
+                    response = await asyncio.to_thread(
+                        self.client.models.generate_content,
+                        model=MODEL,
+                        contents=contents,
+                        config={
+                            "temperature":0.0,
+                            "top_p":0.0,
+                        }
+                    )
+        return response
+
+    async def process_question(self, video_id: str, question: str) -> Dict:
         """
         Process a single question with its associated frames
 
@@ -90,8 +208,16 @@ output the best answer letter choice in <answer></answer> tags. Here is the mult
             if not frame_paths:
                 raise FileNotFoundError(f"No frames found for video ID {video_id}")
 
-            # Load all frames as PIL Images
-            frames = [self.load_frame(path) for path in frame_paths]
+            # Frame uploads and reads share the concurrency limit with the requests themselves
+            async with self.semaphore:
+                if self.upload_frames:
+                    # Reference frames uploaded to the Files API
+                    frames = await asyncio.gather(*(self.upload_frame(path) for path in frame_paths))
+                else:
+                    # Load all frames as inline JPEG parts, off the event loop
+                    frames = await asyncio.gather(
+                        *(asyncio.to_thread(self.load_frame, path) for path in frame_paths)
+                    )
 
             # Create contents list with prompt and frames
             contents = [
@@ -100,14 +226,7 @@ output the best answer letter choice in <answer></answer> tags. Here is the mult
             ]
 
             # Make API request using the flash-thinking model
-            response = self.client.models.generate_content(
-                model='gemini-2.0-pro-exp-02-05',
-                contents=contents,
-                config={
-                    "temperature":0.0,
-                    "top_p":0.0,
-                }
-            )
+            response = await self.generate(contents)
 
             # Extract the response content
             result = {
@@ -127,42 +246,72 @@ output the best answer letter choice in <answer></answer> tags. Here is the mult
             logger.error(f"Error processing video ID {video_id}: {str(e)}")
             return {"error": str(e)}
 
+    async def process_and_save(self, q: Dict) -> Dict:
+        """
+        Process a single question and save its result as soon as it completes
+
+        Args:
+            q (Dict): Dictionary containing video_id and question
+
+        Returns:
+            Dict: API response
+        """
+        result = await self.process_question(q['id'], q['question'])
+        self.save_result({"video_id": q['id'], **result})
+
+        logger.info(f"Completed processing video ID: {q['id']}")
+        return result
+
+    async def process_batch(self, questions: List[Dict]) -> List[Dict]:
+        """
+        Process a batch of questions concurrently
+
+        Args:
+            questions (List[Dict]): List of dictionaries containing video_id and question
+
+        Returns:
+            List[Dict]: List of results, in the same order as questions
+        """
+        tasks = []
+        for q in questions:
+            task = self.process_and_save(q)
+            tasks.append(task)
+
+        return await asyncio.gather(*tasks)
+
 from dotenv import load_dotenv
 load_dotenv()  # Load environment variables from .env file
 
-def main():
+async def main():
     # Load API key from environment variable
     api_key = os.getenv('GOOGLE_API_KEY')
     if not api_key:
         raise ValueError("GOOGLE_API_KEY environment variable not set")
 
-    # Initialize processor
-    processor = GeminiFlashProcessor(api_key)
-
     # Create output directory for results
     output_dir = Path('gemini_pro_results')
     output_dir.mkdir(exist_ok=True)
 
-    # Read questions from CSV
-    with open('questions.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        # Process each question
-        for row in reader:
-            video_id = row['id']
-            question = row['question']
+    # Results of earlier runs are kept, so only unfinished questions are sent again
+    results_path = output_dir / 'results.ndjson'
+    done = completed_video_ids(results_path)
 
-            logger.info(f"Processing video ID: {video_id}")
-
-            # Process the question
-            result = processor.process_question(video_id, question)
+    # Initialize processor
+    processor = GeminiFlashProcessor(api_key, results_path=results_path)
 
-            # Save result to JSON file
-            output_path = output_dir / f"{video_id}_result.json"
-            with open(output_path, 'w') as f:
-                json.dump(result, f, indent=2)
+    # Read all questions from CSV, skipping those already answered
+    questions = []
+    with open('questions.csv', 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        questions = list(reader)
+    questions = [q for q in questions if q['id'] not in done]
 
-            logger.info(f"Completed processing video ID: {video_id}")
+    # Process questions in parallel
+    logger.info(f"Processing {len(questions)} questions in parallel ({len(done)} already done)...")
+    try:
+        await processor.process_batch(questions)  # Results are saved as they complete
+    finally:
+        processor.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
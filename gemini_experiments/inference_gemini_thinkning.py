@@ -1,42 +1,112 @@
 import os
+import sys
 import csv
+import asyncio
+import httpx
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
-import PIL.Image
+import orjson
+from asyncio import Semaphore
 from google import genai
+from google.genai import errors, types
+from tenacity import retry_if_exception
 from google.generativeai import GenerationConfig
 from dotenv import load_dotenv
 
+# Make the shared helpers at the repo root importable when run from this folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import frame_cache
+from progress import completed_video_ids, open_results
+from rate_limit import api_retrying
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Files uploaded to the Gemini API are deleted after 48 hours; forget them a little earlier
+GEMINI_FILE_TTL = 47 * 60 * 60
+
+MODEL = 'gemini-2.0-flash-thinking-exp'
+
+def is_transient_error(e: BaseException) -> bool:
+    """Rate limits, server-side failures, timeouts and dropped connections are worth retrying; other errors are not"""
+    # google-genai raises timeouts and connection errors straight from httpx
+    return (
+        isinstance(e, (errors.ServerError, httpx.TransportError))
+        or (isinstance(e, errors.ClientError) and e.code == 429)
+    )
+
 class GeminiFlashProcessor:
-    def __init__(self, api_key: str = ""):
+    def __init__(self, api_key: str = "", max_concurrent_requests: int = 10, frame_count: int = 5,
+                 upload_frames: bool = True, results_path: str = "results.ndjson"):
         """
         Initialize the Gemini Flash processor with API credentials
 
         Args:
             api_key (str): Google API key
+            max_concurrent_requests (int): Maximum number of concurrent API requests
+            frame_count (int): Number of frames shown per question
+            upload_frames (bool): Upload frames once and reference them by URI instead of sending them inline
+            results_path (str): NDJSON file that results are appended to, one per line
         """
         self.client = genai.Client(
             api_key=api_key,
             http_options={'api_version': 'v1alpha'}
         )
+        self.semaphore = Semaphore(max_concurrent_requests)
+        self._prompt_prefix = self.create_prompt_prefix(frame_count)
+        self.upload_frames = upload_frames
+        self.out_f = open_results(results_path)
+
+    def save_result(self, result: Dict):
+        """
+        Append a result to the NDJSON results file
+
+        Args:
+            result (Dict): Result including its video_id
+        """
+        # A single write with no await in between, so concurrent tasks can't interleave lines
+        self.out_f.write(orjson.dumps(result) + b'\n')
+        self.out_f.flush()
+
+    def close(self):
+        """
+        Close the results file
+        """
+        self.out_f.close()
+
+    def load_frame(self, image_path: str) -> types.Part:
+        """
+        Load a frame as an inline JPEG part
+
+        The raw JPEG bytes are handed to the SDK as they are, so the frame is
+        never decoded and re-encoded on the way to the API.
 
-    def load_frame(self, image_path: str) -> PIL.Image.Image:
+        Args:
+            image_path (str): Path to the image file
+
+        Returns:
+            types.Part: Part holding the frame's JPEG bytes
         """
-        Load an image file using PIL
+        return types.Part.from_bytes(data=Path(image_path).read_bytes(), mime_type='image/jpeg')
+
+    async def upload_frame(self, image_path: str) -> types.Part:
+        """
+        Upload a frame to the Gemini Files API, reusing an earlier upload while it is still live
 
         Args:
             image_path (str): Path to the image file
 
         Returns:
-            PIL.Image.Image: PIL Image object
+            types.Part: Part referencing the uploaded frame
         """
-        return PIL.Image.open(image_path)
+        uri = frame_cache.get_upload("gemini", image_path)
+        if uri is None:
+            uploaded = await asyncio.to_thread(self.client.files.upload, file=image_path)
+            uri = uploaded.uri
+            frame_cache.set_upload("gemini", image_path, uri, expire=GEMINI_FILE_TTL)
+        return types.Part.from_uri(file_uri=uri, mime_type='image/jpeg')
 
     def get_frame_paths(self, video_id: str) -> List[str]:
         """
@@ -48,22 +118,32 @@ class GeminiFlashProcessor:
         Returns:
             List[str]: List of frame image paths
         """
-        frame_dir = Path('extracted_frames') / str(video_id)
-        frame_paths = sorted(list(frame_dir.glob('frame_*.jpg')))
-        return [str(path) for path in frame_paths]
+        frame_dir = os.path.join('extracted_frames', str(video_id))
+        try:
+            with os.scandir(frame_dir) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.name.startswith('frame_') and entry.name.endswith('.jpg')
+                    and entry.name[6:-4].isdigit()
+                ]
+        except FileNotFoundError:
+            return []
 
-    def create_prompt(self, question: str, frame_count: int = 5) -> str:
+        # Sort by frame number, so frame_10 comes after frame_9
+        names.sort(key=lambda name: int(name[6:-4]))
+        return [os.path.join(frame_dir, name) for name in names]
+
+    def create_prompt_prefix(self, frame_count: int = 5) -> str:
         """
-        Create the prompt for Gemini
+        Create the constant part of the prompt for Gemini, everything before the question
 
         Args:
-            question (str): The question to answer
             frame_count (int): Number of frames
 
         Returns:
-            str: Formatted prompt
+            str: Prompt text that precedes the question
         """
-        return f"""You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver's forward-facing perspective.
+        return """You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver's forward-facing perspective.
 
 Using these frames, answer the following multiple-choice question. Incorporate any relevant details observed in the frames (for example, lanes, signage, vehicles, pedestrians, traffic signals, road markings, obstructions) that might help in selecting the correct answer. Consider how details may change across the frames and note that some frames may be more crucial than others.
 
@@ -75,10 +155,48 @@ Steps to follow:
 
 Now, here is the question and its multiple-choice options:
 
-{question}
 """
 
-    def process_question(self, video_id: str, question: str) -> Dict:
+    def create_prompt(self, question: str) -> str:
+        """
+        Create the prompt for Gemini
+
+        Args:
+            question (str): The question to answer
+
+        Returns:
+            str: Formatted prompt
+        """
+        return self._prompt_prefix + question + "\n"
+
+    async def generate(self, contents: List):
+        """
+        Send a request to the model, retrying with exponential backoff on rate limits and server errors
+
+        Each attempt takes its own slot of the concurrency limit, so a request
+        waiting out its backoff doesn't keep other requests from being sent.
+
+        Args:
+            contents (List): Prompt and frames
+
+        Returns:
+            GenerateContentResponse: API response
+        """
+        async for attempt in api_retrying(retry_if_exception(is_transient_error)):
+            with attempt:
+                async with self.semaphore:  # Limit concurrent requests
+                    response = await asyncio.to_thread(
+                        self.client.models.generate_content,
+                        model=MODEL,
+                        contents=contents,
+                        config={
+                            "temperature": 0.0,
+                            "top_p": 0.0,
+                        }
+                    )
+        return response
+
+    async def process_question(self, video_id: str, question: str) -> Dict:
         """
         Process a single question with its associated frames
 
@@ -96,8 +214,16 @@ Now, here is the question and its multiple-choice options:
             if not frame_paths:
                 raise FileNotFoundError(f"No frames found for video ID {video_id}")
 
-            # Load all frames as PIL Images
-            frames = [self.load_frame(path) for path in frame_paths]
+            # Frame uploads and reads share the concurrency limit with the requests themselves
+            async with self.semaphore:
+                if self.upload_frames:
+                    # Reference frames uploaded to the Files API
+                    frames = await asyncio.gather(*(self.upload_frame(path) for path in frame_paths))
+                else:
+                    # Load all frames as inline JPEG parts, off the event loop
+                    frames = await asyncio.gather(
+                        *(asyncio.to_thread(self.load_frame, path) for path in frame_paths)
+                    )
 
             # Create contents list with prompt and frames
             contents = [
@@ -106,14 +232,7 @@ Now, here is the question and its multiple-choice options:
             ]
 
             # Make the API call
-            response = self.client.models.generate_content(
-                model='gemini-2.0-flash-thinking-exp',
-                contents=contents,
-                config={
-                    "temperature": 0.0,
-                    "top_p": 0.0,
-                }
-            )
+            response = await self.generate(contents)
 
             # Extract the response content
             result = {
@@ -137,9 +256,25 @@ Now, here is the question and its multiple-choice options:
                 "error": str(e)
             }
 
-    def process_batch(self, questions: List[Dict]) -> List[Dict]:
+    async def process_and_save(self, q: Dict) -> Dict:
+        """
+        Process a single question and save its result as soon as it completes
+
+        Args:
+            q (Dict): Dictionary containing video_id and question
+
+        Returns:
+            Dict: API response
+        """
+        result = await self.process_question(q['id'], q['question'])
+        self.save_result(result)
+
+        logger.info(f"Processed and saved result for video ID: {q['id']}")
+        return result
+
+    async def process_batch(self, questions: List[Dict]) -> List[Dict]:
         """
-        Process a batch of questions sequentially
+        Process a batch of questions concurrently
 
         Args:
             questions (List[Dict]): List of dictionaries containing video_id and question
@@ -147,27 +282,10 @@ Now, here is the question and its multiple-choice options:
         Returns:
             List[Dict]: List of results
         """
-        results = []
-        for q in questions:
-            result = self.process_question(q['id'], q['question'])
-            
-            # Save result immediately after processing each question
-            output_dir = Path('gemini_flash_results0')
-            output_path = output_dir / f"{q['id']}_result.json"
-            
-            # Ensure we don't modify the original result when saving
-            result_to_save = result.copy()
-            result_to_save.pop('video_id', None)  # Remove video_id before saving
-            
-            with open(output_path, 'w') as f:
-                json.dump(result_to_save, f, indent=2)
-            
-            results.append(result)
-            logger.info(f"Processed and saved result for video ID: {q['id']}")
-        
-        return results
-
-def main():
+        tasks = [self.process_and_save(q) for q in questions]
+        return await asyncio.gather(*tasks)
+
+async def main():
     # Load environment variables
     load_dotenv()
     
@@ -176,23 +294,31 @@ def main():
     if not api_key:
         raise ValueError("GOOGLE_API_KEY environment variable not set")
 
-    # Initialize processor
-    processor = GeminiFlashProcessor(api_key)
-
     # Create output directory for results
     output_dir = Path('gemini_flash_results0')
     output_dir.mkdir(exist_ok=True)
 
-    # Read all questions from CSV
+    # Results of earlier runs are kept, so only unfinished questions are sent again
+    results_path = output_dir / 'results.ndjson'
+    done = completed_video_ids(results_path)
+
+    # Initialize processor
+    processor = GeminiFlashProcessor(api_key, results_path=results_path)
+
+    # Read all questions from CSV, skipping those already answered
     questions = []
     with open('questions.csv', 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         questions = list(reader)
-
-    # Process questions sequentially
-    logger.info(f"Processing {len(questions)} questions sequentially...")
-    processor.process_batch(questions)  # No need to store results since we're saving as we go
+    questions = [q for q in questions if q['id'] not in done]
+
+    # Process questions in parallel
+    logger.info(f"Processing {len(questions)} questions in parallel ({len(done)} already done)...")
+    try:
+        await processor.process_batch(questions)  # No need to store results since we're saving as we go
+    finally:
+        processor.close()
     logger.info("Processing completed!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -1,22 +1,50 @@
 import os
-import csv
 import asyncio
 import logging
+import pandas as pd
 from pathlib import Path
-import json
-from asyncio import Semaphore
+import orjson
 from typing import List, Dict
+from google.api_core import exceptions as api_exceptions
 from google.cloud import aiplatform
 from vertexai.generative_models import GenerativeModel, Part
-import PIL.Image
-from io import BytesIO
+from tenacity import retry_if_exception_type
+from progress import completed_video_ids
+from rate_limit import CreditSemaphore, api_retrying
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Everything in the prompt but the question is the same for every call, so build it once
+_PROMPT_PREFIX = """You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver’s forward-facing perspective.
+
+Using these frames, answer the following multiple-choice question by choosing the single best answer. Incorporate any relevant details observed in the frames (for example, lanes, signage, vehicles, pedestrians, traffic signals, road markings, obstructions) that might help in selecting the correct answer. Consider how details may change across the frames and note that some frames may be more crucial than others. Explain your reasoning in detail.
+
+Steps to follow:
+1. **Frame-by-Frame Analysis:** Describe the significant elements you notice in each of the 5 frames (e.g., signs, road markings, obstructions, other vehicles, potential hazards). Make sure you particularly pay attention to road markings or signs with directional arrows whenever the question asks about the possible directions a given lane can go. 
+2. **Contextual Reasoning:** Integrate the observations from each frame. Think about what is happening over time, which elements are most relevant, and how they connect to the question.
+3. **Match to Answer Choices:** Relate your findings to each of the multiple-choice options. Eliminate those that are inconsistent with the visual evidence or standard traffic rules, and select the most appropriate remaining choice.
+4. **Provide the Best Answer:** Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
+
+Now, here is the question and its multiple-choice options:
+
+"""
+_PROMPT_SUFFIX = "\n"
+
+# Errors worth retrying: quota (429), server errors and timeouts
+TRANSIENT_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded
+)
+
+# Questions in flight at once
+BATCH_SIZE = 64
+
 class GeminiProcessor:
-    def __init__(self, project_id: str, location: str = "us-central1", max_concurrent_requests: int = 5):
+    def __init__(self, project_id: str, location: str = "us-central1", requests_per_minute: int = 60):
         """Initialize the Gemini processor"""
         # Initialize Vertex AI
         aiplatform.init(
@@ -24,93 +52,105 @@ class GeminiProcessor:
             location=location
         )
         
+        # A single model instance for all requests, so they share its async gRPC channel
         self.model = GenerativeModel("gemini-2.0-pro-exp-02-05")
-        self.semaphore = Semaphore(max_concurrent_requests)
+        # One credit per request, refunded a minute later, to stay under the per-minute quota
+        self.semaphore = CreditSemaphore(total_credits=requests_per_minute)
 
     def get_frame_paths(self, video_id: str) -> List[str]:
         """Get paths for all frames of a specific video"""
-        frame_dir = Path('extracted_frames') / str(video_id)
-        frame_paths = sorted(list(frame_dir.glob('frame_*.jpg')))
-        return [str(path) for path in frame_paths]
+        frame_dir = os.path.join('extracted_frames', str(video_id))
+        try:
+            with os.scandir(frame_dir) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.name.startswith('frame_') and entry.name.endswith('.jpg')
+                    and entry.name[6:-4].isdigit()
+                ]
+        except FileNotFoundError:
+            return []
+
+        # Sort by frame number, so frame_10 comes after frame_9
+        names.sort(key=lambda name: int(name[6:-4]))
+        return [os.path.join(frame_dir, name) for name in names]
 
-    def image_to_bytes(self, image: PIL.Image.Image) -> bytes:
-        """Convert PIL Image to bytes"""
-        img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format='JPEG')
-        return img_byte_arr.getvalue()
+    def _build_image_parts(self, frame_paths: List[str]) -> List[Part]:
+        """Create image parts for each frame straight from the JPEG files"""
+        image_parts = []
+        for path in frame_paths:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            image_parts.append(Part.from_data(data=image_bytes, mime_type="image/jpeg"))
+        return image_parts
 
     def create_prompt(self, question: str) -> str:
         """Create the prompt for Gemini"""
-        return f"""You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver’s forward-facing perspective.
+        return _PROMPT_PREFIX + question + _PROMPT_SUFFIX
 
-Using these frames, answer the following multiple-choice question by choosing the single best answer. Incorporate any relevant details observed in the frames (for example, lanes, signage, vehicles, pedestrians, traffic signals, road markings, obstructions) that might help in selecting the correct answer. Consider how details may change across the frames and note that some frames may be more crucial than others. Explain your reasoning in detail.
+    async def save_result(self, output_dir: Path, video_id: str, result: Dict):
+        """Write a question's result to <output_dir>/<video_id>_result.json"""
+        output_path = output_dir / f"{video_id}_result.json"
+        await asyncio.to_thread(output_path.write_bytes, orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        logger.info(f"Saved result for video {video_id}")
 
-Steps to follow:
-1. **Frame-by-Frame Analysis:** Describe the significant elements you notice in each of the 5 frames (e.g., signs, road markings, obstructions, other vehicles, potential hazards). Make sure you particularly pay attention to road markings or signs with directional arrows whenever the question asks about the possible directions a given lane can go. 
-2. **Contextual Reasoning:** Integrate the observations from each frame. Think about what is happening over time, which elements are most relevant, and how they connect to the question.
-3. **Match to Answer Choices:** Relate your findings to each of the multiple-choice options. Eliminate those that are inconsistent with the visual evidence or standard traffic rules, and select the most appropriate remaining choice.
-4. **Provide the Best Answer:** Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
+    async def process_question(self, video_id: str, question: str, output_dir: Path) -> Dict:
+        """Process a single question using Gemini API and save its result to output_dir"""
+        try:
+            # Get frame paths
+            frame_paths = self.get_frame_paths(video_id)
+            
+            if not frame_paths:
+                raise FileNotFoundError(f"No frames found for video ID {video_id}")
+            
+            # Read the frames in a worker thread so other requests keep running meanwhile
+            image_parts = await asyncio.to_thread(self._build_image_parts, frame_paths)
+            
+            # Create prompt
+            prompt = self.create_prompt(question)
+            
+            # Prepare contents list with prompt and frames
+            contents = [prompt, *image_parts]
+            
+            # Make API request with temperature and top_p set to 0 once the quota allows it,
+            # backing off and retrying on 429s and transient server errors
+            async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+                with attempt:
+                    response = await self.semaphore.transact(
+                        self.model.generate_content_async(
+                            contents,
+                            generation_config={
+                                "temperature": 0.0,
+                                "top_p": 0.0
+                            }
+                        ),
+                        credits=1,
+                        refund_time=60
+                    )
+            
+            result = {
+                "answer": response.text
+            }
 
-Now, here is the question and its multiple-choice options:
+        except Exception as e:
+            logger.error(f"Error processing video {video_id}: {str(e)}")
+            result = {"error": str(e)}
 
-{question}
-"""
+        await self.save_result(output_dir, video_id, result)
+        return result
 
-    async def process_question(self, video_id: str, question: str) -> Dict:
-        """Process a single question using Gemini API"""
-        async with self.semaphore:
-            try:
-                # Get frame paths
-                frame_paths = self.get_frame_paths(video_id)
-                
-                if not frame_paths:
-                    raise FileNotFoundError(f"No frames found for video ID {video_id}")
-                
-                # Create image parts for each frame
-                image_parts = []
-                for path in frame_paths:
-                    with PIL.Image.open(path) as image:
-                        # Convert image to bytes
-                        image_bytes = self.image_to_bytes(image)
-                        # Create part from bytes
-                        image_part = Part.from_data(data=image_bytes, mime_type="image/jpeg")
-                        image_parts.append(image_part)
-                
-                # Create prompt
-                prompt = self.create_prompt(question)
-                
-                # Prepare contents list with prompt and frames
-                contents = [prompt, *image_parts]
-                
-                # Make API request with temperature and top_p set to 0
-                response = self.model.generate_content(
-                    contents,
-                    generation_config={
-                        "temperature": 0.0,
-                        "top_p": 0.0
-                    }
-                )
-                
-                return {
-                    "video_id": video_id,
-                    "answer": response.text
-                }
-
-            except Exception as e:
-                logger.error(f"Error processing video {video_id}: {str(e)}")
-                return {
-                    "video_id": video_id,
-                    "error": str(e)
-                }
-
-    async def process_batch(self, questions: List[Dict]) -> List[Dict]:
-        """Process multiple questions in parallel"""
-        tasks = []
-        for q in questions:
-            task = self.process_question(q['id'], q['question'])
-            tasks.append(task)
-        
-        return await asyncio.gather(*tasks)
+    async def process_batch(self, questions: List[Dict], output_dir: Path, batch_size: int = BATCH_SIZE):
+        """Process questions (one per video ID) in parallel, one chunk of batch_size at a time; each question saves its own result"""
+        for start in range(0, len(questions), batch_size):
+            chunk = questions[start:start + batch_size]
+            results = await asyncio.gather(
+                *(self.process_question(q['id'], q['question'], output_dir) for q in chunk),
+                return_exceptions=True
+            )
+            
+            # A failure in one question shouldn't lose the rest of the chunk
+            for q, result in zip(chunk, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"Error processing video {q['id']}: {str(result)}")
 
 async def main():
     # Your Google Cloud project ID
@@ -123,27 +163,28 @@ async def main():
     output_dir = Path('gemini_pro_answers')
     output_dir.mkdir(exist_ok=True)
     
-    # Read questions from CSV
-    questions = []
-    with open('all_questions.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            # Convert ID to integer for comparison
-            id_num = int(row['id'])
-            row['id'] = str(id_num).zfill(5)
-            questions.append(row)
+    # Read questions from CSV and add zero padding to IDs
+    df = pd.read_csv('all_questions.csv', dtype={'id': int}, keep_default_na=False)
+    df['id'] = df['id'].astype(str).str.zfill(5)
+    
+    # Results are saved per video ID, so a repeated video ID would only redo the frames and API call
+    # to overwrite the same file; keep only the last question for each video ID
+    repeated = df['id'].duplicated(keep='last')
+    if repeated.any():
+        logger.warning(f"Skipping {repeated.sum()} questions with repeated video IDs")
+        df = df[~repeated]
+    questions = df.to_dict('records')
+    
+    # Skip questions answered by an earlier run
+    done = completed_video_ids(output_dir)
+    remaining = [q for q in questions if q['id'] not in done]
+    if len(remaining) < len(questions):
+        logger.info(f"Skipping {len(questions) - len(remaining)} questions that already have results")
+    questions = remaining
     
     # Process questions
     logger.info(f"Processing {len(questions)} questions...")
-    results = await processor.process_batch(questions)
-    
-    # Save results
-    for result in results:
-        video_id = result.pop('video_id')
-        output_path = output_dir / f"{video_id}_result.json"
-        with open(output_path, 'w') as f:
-            json.dump(result, f, indent=2)
-        logger.info(f"Saved result for video {video_id}")
+    await processor.process_batch(questions, output_dir)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
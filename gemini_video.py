@@ -1,20 +1,46 @@
 import os
-import csv
 import asyncio
 import logging
+import pandas as pd
 from pathlib import Path
-import json
-from asyncio import Semaphore
+import orjson
 from typing import List, Dict
+from google.api_core import exceptions as api_exceptions
 from google.cloud import aiplatform
 from vertexai.generative_models import GenerativeModel, Part
+from tenacity import retry_if_exception_type
+from progress import completed_video_ids
+from rate_limit import CreditSemaphore, api_retrying
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Everything in the prompt but the question is the same for every call, so build it once
+_PROMPT_PREFIX = """You are analyzing a dashcam video taken from the driver's forward-facing perspective.
+                
+                Using this video, answer the following multiple-choice question by choosing the single best answer.
+                Incorporate any relevant details observed in the video (for example, lanes, signage, vehicles, 
+                pedestrians, traffic signals, road markings, obstructions) that might help in selecting the correct answer. 
+                Explain your reasoning in detail. Relate your findings to each of the multiple-choice options. Eliminate those that are inconsistent with the visual evidence or standard traffic rules, and select the most appropriate remaining choice.
+                Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
+                
+                Question: """
+_PROMPT_SUFFIX = "\n                "
+
+# Errors worth retrying: quota (429), server errors and timeouts
+TRANSIENT_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded
+)
+
+# Questions in flight at once
+BATCH_SIZE = 64
+
 class GeminiProcessor:
-    def __init__(self, project_id: str, location: str = "us-central1", max_concurrent_requests: int = 5):
+    def __init__(self, project_id: str, location: str = "us-central1", requests_per_minute: int = 60):
         """Initialize the Gemini processor"""
         # Initialize Vertex AI
         aiplatform.init(
@@ -22,70 +48,68 @@ class GeminiProcessor:
             location=location
         )
         
+        # A single model instance for all requests, so they share its async gRPC channel
         self.model = GenerativeModel("gemini-2.0-flash-001")
         # self.model = GenerativeModel("gemini-1.5-pro")
-        self.semaphore = Semaphore(max_concurrent_requests)
-        self.request_count = 0
-        self.batch_size = 5  # Number of requests before sleeping
-        self.sleep_duration = 0  # Sleep duration in seconds
+        # One credit per request, refunded a minute later, to stay under the per-minute quota
+        self.semaphore = CreditSemaphore(total_credits=requests_per_minute)
 
-    async def process_question(self, video_id: str, question: str) -> Dict:
-        """Process a single question using Gemini API"""
-        async with self.semaphore:
-            try:
-                # Direct GCS path to video
-                video_path = f"gs://tesla_videos/videos/{video_id.zfill(5)}.mp4"
-                
-                # Create video part using GCS path
-                video_part = Part.from_uri(
-                    uri=video_path,
-                    mime_type="video/mp4"
-                )
-                
-                # Prepare prompt
-                prompt = f"""You are analyzing a dashcam video taken from the driver's forward-facing perspective.
-                
-                Using this video, answer the following multiple-choice question by choosing the single best answer.
-                Incorporate any relevant details observed in the video (for example, lanes, signage, vehicles, 
-                pedestrians, traffic signals, road markings, obstructions) that might help in selecting the correct answer. 
-                Explain your reasoning in detail. Relate your findings to each of the multiple-choice options. Eliminate those that are inconsistent with the visual evidence or standard traffic rules, and select the most appropriate remaining choice.
-                Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
-                
-                Question: {question}
-                """
-                
-                # Make API request
-                contents = [video_part, prompt]
-                response = self.model.generate_content(contents)
-                
-                # Increment request counter
-                self.request_count += 1
-                
-                # Check if we need to sleep
-                if self.request_count % self.batch_size == 0:
-                    logger.info(f"Processed {self.request_count} requests. Sleeping for {self.sleep_duration} seconds...")
-                    await asyncio.sleep(self.sleep_duration)
-                
-                return {
-                    "video_id": video_id,
-                    "answer": response.text
-                }
+    async def save_result(self, output_dir: Path, video_id: str, result: Dict):
+        """Write a question's result to <output_dir>/<video_id>_result.json"""
+        output_path = output_dir / f"{video_id}_result.json"
+        await asyncio.to_thread(output_path.write_bytes, orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        logger.info(f"Saved result for video {video_id}")
 
-            except Exception as e:
-                logger.error(f"Error processing video {video_id}: {str(e)}")
-                return {
-                    "video_id": video_id,
-                    "error": str(e)
-                }
+    async def process_question(self, video_id: str, question: str, output_dir: Path) -> Dict:
+        """Process a single question using Gemini API and save its result to output_dir"""
+        try:
+            # Direct GCS path to video
+            video_path = f"gs://tesla_videos/videos/{video_id.zfill(5)}.mp4"
+            
+            # Create video part using GCS path
+            video_part = Part.from_uri(
+                uri=video_path,
+                mime_type="video/mp4"
+            )
+            
+            # Prepare prompt
+            prompt = _PROMPT_PREFIX + question + _PROMPT_SUFFIX
+            
+            # Make API request once the quota allows it, backing off and retrying
+            # on 429s and transient server errors
+            contents = [video_part, prompt]
+            async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+                with attempt:
+                    response = await self.semaphore.transact(
+                        self.model.generate_content_async(contents),
+                        credits=1,
+                        refund_time=60
+                    )
+            
+            result = {
+                "answer": response.text
+            }
 
-    async def process_batch(self, questions: List[Dict]) -> List[Dict]:
-        """Process multiple questions in parallel"""
-        tasks = []
-        for q in questions:
-            task = self.process_question(q['id'], q['question'])
-            tasks.append(task)
-        
-        return await asyncio.gather(*tasks)
+        except Exception as e:
+            logger.error(f"Error processing video {video_id}: {str(e)}")
+            result = {"error": str(e)}
+
+        await self.save_result(output_dir, video_id, result)
+        return result
+
+    async def process_batch(self, questions: List[Dict], output_dir: Path, batch_size: int = BATCH_SIZE):
+        """Process questions (one per video ID) in parallel, one chunk of batch_size at a time; each question saves its own result"""
+        for start in range(0, len(questions), batch_size):
+            chunk = questions[start:start + batch_size]
+            results = await asyncio.gather(
+                *(self.process_question(q['id'], q['question'], output_dir) for q in chunk),
+                return_exceptions=True
+            )
+            
+            # A failure in one question shouldn't lose the rest of the chunk
+            for q, result in zip(chunk, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"Error processing video {q['id']}: {str(result)}")
 
 async def main():
     # Your Google Cloud project ID
@@ -98,27 +122,28 @@ async def main():
     output_dir = Path('gemini_video_answers')
     output_dir.mkdir(exist_ok=True)
     
-    # Read questions from CSV
-    questions = []
-    with open('all_questions.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            # Convert ID to integer for comparison
-            id_num = int(row['id'])
-            row['id'] = str(id_num).zfill(5)
-            questions.append(row)
+    # Read questions from CSV and add zero padding to IDs
+    df = pd.read_csv('all_questions.csv', dtype={'id': int}, keep_default_na=False)
+    df['id'] = df['id'].astype(str).str.zfill(5)
+    
+    # Results are saved per video ID, so a repeated video ID would only repeat the API call (and its quota)
+    # to overwrite the same file; keep only the last question for each video ID
+    repeated = df['id'].duplicated(keep='last')
+    if repeated.any():
+        logger.warning(f"Skipping {repeated.sum()} questions with repeated video IDs")
+        df = df[~repeated]
+    questions = df.to_dict('records')
+    
+    # Skip questions answered by an earlier run
+    done = completed_video_ids(output_dir)
+    remaining = [q for q in questions if q['id'] not in done]
+    if len(remaining) < len(questions):
+        logger.info(f"Skipping {len(questions) - len(remaining)} questions that already have results")
+    questions = remaining
     
     # Process questions
     logger.info(f"Processing {len(questions)} questions...")
-    results = await processor.process_batch(questions)
-    
-    # Save results
-    for result in results:
-        video_id = result.pop('video_id')
-        output_path = output_dir / f"{video_id}_result.json"
-        with open(output_path, 'w') as f:
-            json.dump(result, f, indent=2)
-        logger.info(f"Saved result for video {video_id}")
+    await processor.process_batch(questions, output_dir)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
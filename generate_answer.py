@@ -7,7 +7,7 @@ from openai import AsyncOpenAI
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
+import orjson
 from asyncio import Semaphore
 from dotenv import load_dotenv
 
@@ -198,8 +198,8 @@ async def main():
         video_id = result.pop('video_id')  # Remove video_id before saving
         output_path = output_dir / f"{video_id}_result.json"
         
-        with open(output_path, 'w') as f:
-            json.dump(result, f, indent=2)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
         
         logger.info(f"Completed processing video ID: {video_id}")
 
@@ -1,44 +1,97 @@
 import os
-import csv
-import base64
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai import APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from tenacity import retry_if_exception_type
 from pathlib import Path
 import logging
-from typing import List, Dict
-import json
-from asyncio import Semaphore
+import pandas as pd
+from typing import Any, Awaitable, Callable, List, Dict, Optional
+import orjson
 from dotenv import load_dotenv
+import frame_cache
+from progress import completed_video_ids
+from rate_limit import CreditSemaphore, api_retrying
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Everything in the prompt but the question is the same for every call, so build it once.
+# Reasoner models work best with striaght forward prompts and let them do the thinking and reasoning for you. Don't get in thier way!
+_PROMPT_PREFIX = """You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver’s forward-facing perspective.
+
+Using these frames, answer the following multiple-choice question by choosing the single best answer. Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
+
+Now, here is the question and its multiple-choice options:
+"""
+_PROMPT_SUFFIX = "\n"
+
+# Rough tokens one request counts against the TPM limit, including o1's reasoning tokens
+REQUEST_TOKENS = 25000
+
+# Errors worth retrying; APIConnectionError also covers timeouts
+TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Send questions through the Batch API (half price, results within 24h) instead of live requests
+USE_BATCH_API = False
+
+# Batch API input files are capped at 200 MB; leave some headroom
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+
 class AsyncGPT4VProcessor:
-    def __init__(self, api_key: str = "", max_concurrent_requests: int = 5):
+    def __init__(self, api_key: str = "", tokens_per_minute: int = 450000):
         """
         Initialize the GPT-4V processor with API credentials
         
         Args:
             api_key (str): OpenAI API key
-            max_concurrent_requests (int): Maximum number of concurrent API requests
+            tokens_per_minute (int): Tokens-per-minute limit of the account for this model
         """
-        self.client = AsyncOpenAI(api_key=api_key)
-        self.semaphore = Semaphore(max_concurrent_requests)
+        # Pool keep-alive HTTP/2 connections so concurrent requests reuse them; the pool is
+        # sized well above the semaphore so the semaphore stays the only bottleneck.
+        # DefaultAsyncHttpxClient keeps the SDK's own timeout and redirect settings
+        self.http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+        # Retries are handled in process_question so backoff doesn't hold up the token budget
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        # Budget requests by the tokens they use rather than how many are in flight
+        self.semaphore = CreditSemaphore(total_credits=tokens_per_minute)
+        # Only this many requests fit in the budget at once; more workers would just hold
+        # encoded frames while waiting on the semaphore
+        self.num_workers = max(1, tokens_per_minute // REQUEST_TOKENS)
+        # Frames for upcoming questions are read and encoded here while requests are in flight;
+        # one thread is enough since the producer builds one question at a time
+        self.encode_pool = ThreadPoolExecutor(max_workers=1)
 
-    def encode_image(self, image_path: str) -> str:
+    async def close(self):
         """
-        Encode an image file to base64
+        Close the pooled HTTP connections and the encoding thread
+        """
+        await self.http_client.aclose()
+        self.encode_pool.shutdown()
+
+    @staticmethod
+    def encode_image(image_path: str) -> str:
+        """
+        Encode an image file to a base64 data URL
+        
+        frame_cache keeps the result on disk across runs, since frames never
+        change once extracted. Each frame is used by one question only, so
+        nothing is kept in memory.
         
         Args:
             image_path (str): Path to the image file
             
         Returns:
-            str: Base64 encoded image
+            str: data:image/jpeg;base64 URL of the image
         """
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+        return frame_cache.get_data_url(image_path)
 
     def get_frame_paths(self, video_id: str) -> List[str]:
         """
@@ -50,110 +103,330 @@ class AsyncGPT4VProcessor:
         Returns:
             List[str]: List of frame image paths
         """
-        frame_dir = Path('extracted_frames') / str(video_id)
-        frame_paths = sorted(list(frame_dir.glob('frame_*.jpg')))
-        return [str(path) for path in frame_paths]
+        frame_dir = os.path.join('extracted_frames', str(video_id))
+        try:
+            with os.scandir(frame_dir) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.name.startswith('frame_') and entry.name.endswith('.jpg')
+                    and entry.name[6:-4].isdigit()
+                ]
+        except FileNotFoundError:
+            return []
 
-    def create_prompt(self, question: str, frame_count: int = 5) -> str:
+        # Sort by frame number, so frame_10 comes after frame_9
+        names.sort(key=lambda name: int(name[6:-4]))
+        return [os.path.join(frame_dir, name) for name in names]
+
+    def create_prompt(self, question: str) -> str:
         """
         Create the prompt for GPT-4V
         
         Args:
             question (str): The question to answer
-            frame_count (int): Number of frames
             
         Returns:
             str: Formatted prompt
         """
-        # Reasoner models work best with striaght forward prompts and let them do the thinking and reasoning for you. Don't get in thier way!
-        return f"""You have 5 equally spaced frames (Frame 1 through Frame 5) captured from a 5-second dashcam video, taken from the driver’s forward-facing perspective.
+        return _PROMPT_PREFIX + question + _PROMPT_SUFFIX
 
-Using these frames, answer the following multiple-choice question by choosing the single best answer. Conclude with the final choice that best matches the situation. Output that choice in `<answer></answer>` tags.
+    def _build_content(self, video_id: str, question: str) -> List[Dict]:
+        """
+        Build the message content for a question: the text prompt followed by every frame
+        
+        Args:
+            video_id (str): ID of the video/question
+            question (str): The question to answer
+            
+        Returns:
+            List[Dict]: Content parts for the user message
+        """
+        frame_paths = self.get_frame_paths(video_id)
+        
+        if not frame_paths:
+            raise FileNotFoundError(f"No frames found for video ID {video_id}")
+        
+        # Prepare the content list with the initial text prompt
+        content = [
+            {
+                "type": "text",
+                "text": self.create_prompt(question)
+            }
+        ]
+        
+        # Add each frame as an image_url
+        for path in frame_paths:
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": self.encode_image(path)
+                }
+            })
+        
+        return content
 
-Now, here is the question and its multiple-choice options:
-{question}
-"""
+    def _request_body(self, content: List[Dict]) -> Dict:
+        """
+        Build the chat completion request for a question, shared by live and Batch API requests
+        
+        Args:
+            content (List[Dict]): Content parts for the user message
+            
+        Returns:
+            Dict: Keyword arguments for chat.completions.create
+        """
+        return {
+            "model": "o1",
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ]
+        }
+
+    async def save_result(self, output_dir: Path, video_id: str, result: Dict):
+        """
+        Write a question's result to <output_dir>/<video_id>_result.json
+        
+        Args:
+            output_dir (Path): Directory to save results in
+            video_id (str): ID of the video/question
+            result (Dict): Answer or error for the question
+        """
+        output_path = output_dir / f"{video_id}_result.json"
+        await asyncio.to_thread(output_path.write_bytes, orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        logger.info(f"Completed processing video ID: {video_id}")
+
+    async def prepare_content(self, video_id: str, question: str) -> List[Dict]:
+        """
+        List, read and encode a question's frames on the encoding thread
+        
+        Args:
+            video_id (str): ID of the video/question
+            question (str): The question to answer
+            
+        Returns:
+            List[Dict]: Content parts for the user message
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.encode_pool, self._build_content, video_id, question)
 
-    async def process_question(self, video_id: str, question: str) -> Dict:
+    async def process_question(self, video_id: str, question: str, output_dir: Path,
+                               content: Optional[List[Dict]] = None) -> Dict:
         """
         Process a single question with its associated frames
         
         Args:
             video_id (str): ID of the video/question
             question (str): The question to answer
+            output_dir (Path): Directory to save the result in
+            content (Optional[List[Dict]]): Message content already built by prepare_content, built here if None
             
         Returns:
-            Dict: API response
+            Dict: API response, as saved
         """
-        async with self.semaphore:  # Limit concurrent requests
-            try:
-                # Get frame paths
-                frame_paths = self.get_frame_paths(video_id)
-                
-                if not frame_paths:
-                    raise FileNotFoundError(f"No frames found for video ID {video_id}")
-
-                # Prepare the content list with the initial text prompt
-                content = [
-                    {
-                        "type": "text",
-                        "text": self.create_prompt(question)
-                    }
-                ]
-                
-                # Add each frame as an image_url
-                for path in frame_paths:
-                    base64_image = self.encode_image(path)
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    })
-
-                # Make API request
-                completion = await self.client.chat.completions.create(
-                    model="o1",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": content
-                        }
-                    ],
-                )
-                
-                # Extract the response content
-                response = {
-                    "video_id": video_id,
-                    "answer": completion.choices[0].message.content,
-                    "finish_reason": completion.choices[0].finish_reason,
-                }
-                
-                return response
+        try:
+            if content is None:
+                content = await self.prepare_content(video_id, question)
 
-            except Exception as e:
-                logger.error(f"Error processing video ID {video_id}: {str(e)}")
-                return {
-                    "video_id": video_id,
-                    "error": str(e)
-                }
+            # Make API request once enough of the token budget is free, backing off
+            # and retrying on rate limits and transient server errors
+            async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+                with attempt:
+                    completion = await self.semaphore.transact(
+                        self.client.chat.completions.create(**self._request_body(content)),
+                        credits=REQUEST_TOKENS,
+                        refund_time=60
+                    )
+            
+            # Extract the response content
+            result = {
+                "answer": completion.choices[0].message.content,
+                "finish_reason": completion.choices[0].finish_reason,
+            }
+
+        except Exception as e:
+            logger.error(f"Error processing video ID {video_id}: {str(e)}")
+            result = {"error": str(e)}
+
+        await self.save_result(output_dir, video_id, result)
+        return result
+
+    async def process_batch(self, questions: List[Dict], output_dir: Path, num_workers: Optional[int] = None):
+        """
+        Process questions concurrently, building each one's content ahead of the API calls
+        
+        A producer reads and encodes frames into a bounded queue while num_workers
+        consumers send requests, so frame preparation overlaps with waiting on the
+        network. Each question saves its own result as soon as it finishes.
+        
+        Args:
+            questions (List[Dict]): List of dictionaries containing video_id and question, one per video ID
+            output_dir (Path): Directory to save results in
+            num_workers (Optional[int]): Number of questions sent to the API at once, as many as the
+                token budget fits if None
+        """
+        num_workers = num_workers or self.num_workers
+        
+        # Bounded to one round of workers so little encoded frame data waits in memory
+        queue = asyncio.Queue(maxsize=num_workers)
+        
+        async def produce():
+            for q in questions:
+                try:
+                    content = await self.prepare_content(q['id'], q['question'])
+                except Exception as e:
+                    content = e
+                await queue.put((q, content))
+            
+            # One stop signal per consumer
+            for _ in range(num_workers):
+                await queue.put(None)
+        
+        async def consume():
+            while (item := await queue.get()) is not None:
+                q, content = item
+                try:
+                    if isinstance(content, Exception):
+                        logger.error(f"Error processing video ID {q['id']}: {str(content)}")
+                        await self.save_result(output_dir, q['id'], {"error": str(content)})
+                    else:
+                        await self.process_question(q['id'], q['question'], output_dir, content=content)
+                except Exception as e:
+                    # Keep consuming so the producer never blocks on a full queue
+                    logger.error(f"Error processing video ID {q['id']}: {str(e)}")
+        
+        await asyncio.gather(produce(), *(consume() for _ in range(num_workers)))
+
+    async def _call_with_retries(self, make_call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Make a Batch API call, retrying on rate limits and transient server errors
+        
+        These calls aren't counted against the token budget, so unlike requests
+        they don't go through the semaphore.
+        
+        Args:
+            make_call (Callable[[], Awaitable[Any]]): Starts a fresh call on each attempt
+            
+        Returns:
+            Any: Whatever the call returns
+        """
+        async for attempt in api_retrying(retry_if_exception_type(TRANSIENT_ERRORS)):
+            with attempt:
+                result = await make_call()
+        return result
 
-    async def process_batch(self, questions: List[Dict]) -> List[Dict]:
+    async def _submit_batch(self, lines: List[bytes]):
         """
-        Process a batch of questions concurrently
+        Upload request lines as a JSONL file and start a Batch API job on them
         
         Args:
-            questions (List[Dict]): List of dictionaries containing video_id and question
+            lines (List[bytes]): One serialized chat completion request per line
             
         Returns:
-            List[Dict]: List of results
+            Batch: The created batch job
+        """
+        data = b"\n".join(lines) + b"\n"
+        batch_input = await self._call_with_retries(lambda: self.client.files.create(
+            file=("batch_input.jsonl", data),
+            purpose="batch"
+        ))
+        batch = await self._call_with_retries(lambda: self.client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        ))
+        logger.info(f"Submitted batch {batch.id} with {len(lines)} requests")
+        return batch
+
+    async def _collect_batch(self, batch, output_dir: Path, poll_interval: float):
+        """
+        Wait for a Batch API job to finish and save a result for every request in it
+        
+        Args:
+            batch (Batch): The batch job to wait for
+            output_dir (Path): Directory to save results in
+            poll_interval (float): Seconds between status checks
+        """
+        while batch.status in ("validating", "in_progress", "finalizing"):
+            await asyncio.sleep(poll_interval)
+            batch = await self._call_with_retries(lambda: self.client.batches.retrieve(batch.id))
+        
+        # Expired or cancelled batches still return whatever finished, so save that first
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            output = await self._call_with_retries(lambda: self.client.files.content(file_id))
+            for line in output.content.splitlines():
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    result = {"error": str(record.get("error") or response.get("body"))}
+                else:
+                    choice = response["body"]["choices"][0]
+                    result = {
+                        "answer": choice["message"]["content"],
+                        "finish_reason": choice["finish_reason"],
+                    }
+                await self.save_result(output_dir, record["custom_id"], result)
+        
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}: {batch.errors}")
+
+    async def process_with_batch_api(self, questions: List[Dict], output_dir: Path, poll_interval: float = 60):
+        """
+        Process questions through the Batch API: half the cost of live requests, results within 24h
+        
+        Requests are split across several batches to stay under the input file size limit. Each
+        batch is submitted as soon as it is full, so only one batch's encoded frames are held in
+        memory and earlier batches are already running while later ones are built.
+        
+        Args:
+            questions (List[Dict]): List of dictionaries containing video_id and question, one per
+                video ID since the video ID is each request's custom_id
+            output_dir (Path): Directory to save results in
+            poll_interval (float): Seconds between status checks on each batch
         """
-        tasks = []
-        for q in questions:
-            task = self.process_question(q['id'], q['question'])
-            tasks.append(task)
+        collects = []
         
-        return await asyncio.gather(*tasks)
+        async def submit(lines: List[bytes]):
+            batch = await self._submit_batch(lines)
+            collects.append(asyncio.create_task(self._collect_batch(batch, output_dir, poll_interval)))
+        
+        try:
+            lines = []
+            group_bytes = 0
+            for q in questions:
+                try:
+                    content = await self.prepare_content(q['id'], q['question'])
+                except Exception as e:
+                    logger.error(f"Error processing video ID {q['id']}: {str(e)}")
+                    await self.save_result(output_dir, q['id'], {"error": str(e)})
+                    continue
+                
+                line = orjson.dumps({
+                    "custom_id": q['id'],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": self._request_body(content)
+                })
+                if lines and group_bytes + len(line) > MAX_BATCH_FILE_BYTES:
+                    await submit(lines)
+                    lines = []
+                    group_bytes = 0
+                lines.append(line)
+                group_bytes += len(line) + 1
+            
+            if lines:
+                await submit(lines)
+        finally:
+            # Let every submitted batch finish and save its results before reporting a failure
+            outcomes = await asyncio.gather(*collects, return_exceptions=True)
+        
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
 
 async def main():
     # Load environment variables
@@ -164,38 +437,48 @@ async def main():
     if not api_key:
         raise ValueError("OPENAI_API_KEY_KOA_4o environment variable not set")
 
-    # Initialize processor with concurrent request limit
-    processor = AsyncGPT4VProcessor(api_key, max_concurrent_requests=5)
+    # Initialize processor
+    processor = AsyncGPT4VProcessor(api_key)
 
     # Create output directory for results
     output_dir = Path('final_answers')
     output_dir.mkdir(exist_ok=True)
 
-    # Read all questions from CSV and add zero padding to IDs
-    questions = []
-    with open('all_questions.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            # Convert ID to int for comparison
-            id_num = int(row['id'])
-            if 51 <= id_num <= 251:
-                # Add zero padding to the ID
-                row['id'] = str(id_num).zfill(5)
-                questions.append(row)
+    # Read all questions from CSV, keep IDs 51-251 and add zero padding to IDs
+    df = pd.read_csv('all_questions.csv', dtype={'id': int}, keep_default_na=False)
+    df = df[df['id'].between(51, 251)]
+    df['id'] = df['id'].astype(str).str.zfill(5)
+
+    # Results are saved per video ID, and the Batch API rejects a file with repeated
+    # custom_ids, so keep only the last question for each video ID
+    repeated = df['id'].duplicated(keep='last')
+    if repeated.any():
+        logger.warning(f"Skipping {repeated.sum()} questions with repeated video IDs")
+        df = df[~repeated]
+    questions = df.to_dict('records')
+
+    # Skip questions answered by an earlier run
+    done = completed_video_ids(output_dir)
+    remaining = [q for q in questions if q['id'] not in done]
+    if len(remaining) < len(questions):
+        logger.info(f"Skipping {len(questions) - len(remaining)} questions that already have results")
+    questions = remaining
 
     # Process questions in parallel
     logger.info(f"Processing {len(questions)} questions in parallel...")
-    results = await processor.process_batch(questions)
-
-    # Save results
-    for result in results:
-        video_id = result.pop('video_id')  # Remove video_id before saving
-        output_path = output_dir / f"{video_id}_result.json"
-        
-        with open(output_path, 'w') as f:
-            json.dump(result, f, indent=2)
-        
-        logger.info(f"Completed processing video ID: {video_id}")
+    try:
+        if USE_BATCH_API:
+            try:
+                await processor.process_with_batch_api(questions, output_dir)
+            except (BadRequestError, RuntimeError) as e:
+                # The model may not be available through the Batch API; finish the rest live
+                logger.warning(f"Batch API failed ({str(e)}); processing remaining questions directly")
+                done = completed_video_ids(output_dir)
+                await processor.process_batch([q for q in questions if q['id'] not in done], output_dir)
+        else:
+            await processor.process_batch(questions, output_dir)
+    finally:
+        await processor.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
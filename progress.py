@@ -0,0 +1,64 @@
+import os
+from pathlib import Path
+from typing import BinaryIO, Set
+import orjson
+
+def completed_video_ids(results_path: Path) -> Set[str]:
+    """
+    Get the video IDs that already have an answer saved
+
+    The saved results are the record of progress, so a re-run only sends the
+    questions that are missing. Results that recorded an error don't count,
+    so they are retried.
+
+    Args:
+        results_path (Path): Directory of <video_id>_result.json files, or an NDJSON results file
+
+    Returns:
+        Set[str]: Video IDs with a saved answer
+    """
+    results_path = Path(results_path)
+    done = set()
+    if results_path.suffix == '.ndjson':
+        if not results_path.exists():
+            return done
+        with open(results_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Blank, or half-written by an interrupted run
+                    continue
+                if 'error' not in record:
+                    done.add(str(record['video_id']))
+        return done
+
+    for path in results_path.glob('*_result.json'):
+        try:
+            if 'error' not in orjson.loads(path.read_bytes()):
+                done.add(path.name[:-len('_result.json')])
+        except orjson.JSONDecodeError:
+            # Half-written by an interrupted run; redo it
+            continue
+    return done
+
+def open_results(path: str) -> BinaryIO:
+    """
+    Open an NDJSON results file for appending
+
+    A run killed mid-write can leave a partial last line; it is ended first so
+    the next record starts on a line of its own instead of being glued onto it.
+
+    Args:
+        path (str): NDJSON results file
+
+    Returns:
+        BinaryIO: File opened in append mode
+    """
+    out_f = open(path, 'ab')
+    if out_f.tell() > 0:
+        with open(path, 'rb') as existing:
+            existing.seek(-1, os.SEEK_END)
+            if existing.read(1) != b'\n':
+                out_f.write(b'\n')
+    return out_f
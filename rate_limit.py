@@ -0,0 +1,83 @@
+import asyncio
+from typing import Any, Awaitable, Set
+from tenacity import AsyncRetrying, retry_base, stop_after_attempt, wait_exponential_jitter
+
+def api_retrying(retry: retry_base) -> AsyncRetrying:
+    """
+    Retry policy shared by every API call: jittered exponential backoff, up to 6 attempts
+
+    Use as ``async for attempt in api_retrying(...): with attempt: ...`` and take
+    the rate limit (semaphore or credits) inside each attempt, so a request
+    backing off doesn't hold a slot other requests could use.
+
+    Args:
+        retry (retry_base): Which errors to retry, e.g. retry_if_exception_type(TRANSIENT_ERRORS)
+
+    Returns:
+        AsyncRetrying: Retrying controller that re-raises the last error once attempts run out
+    """
+    return AsyncRetrying(
+        retry=retry,
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+
+class CreditSemaphore:
+    def __init__(self, total_credits: int):
+        """
+        Semaphore that hands out credits (e.g. tokens or requests) instead of slots
+
+        Credits checked out by a request only come back refund_time seconds
+        after it finishes, so the budget tracks a provider's per-minute limits
+        rather than how many requests happen to be in flight.
+
+        Args:
+            total_credits (int): Credits available per refund window (e.g. tokens per minute)
+        """
+        self.total_credits = total_credits
+        self.available = total_credits
+        self._condition = asyncio.Condition()
+        self._refunds: Set[asyncio.Task] = set()
+
+    async def transact(self, coro: Awaitable[Any], credits: int, refund_time: float) -> Any:
+        """
+        Run a coroutine once enough credits are free
+
+        Args:
+            coro (Awaitable[Any]): Coroutine to run, typically an API call
+            credits (int): Credits the call uses; clamped to total_credits so it can always run
+            refund_time (float): Seconds after the call finishes before its credits are refunded
+
+        Returns:
+            Any: Whatever the coroutine returns
+        """
+        credits = min(credits, self.total_credits)
+        try:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.available >= credits)
+                self.available -= credits
+        except BaseException:
+            # Never started, so don't leave an un-awaited coroutine behind
+            coro.close()
+            raise
+
+        try:
+            return await coro
+        finally:
+            task = asyncio.create_task(self._refund(credits, refund_time))
+            self._refunds.add(task)
+            task.add_done_callback(self._refunds.discard)
+
+    async def _refund(self, credits: int, delay: float):
+        """
+        Give credits back after a delay and wake up waiting requests
+
+        Args:
+            credits (int): Credits to give back
+            delay (float): Seconds to wait first
+        """
+        await asyncio.sleep(delay)
+        async with self._condition:
+            self.available += credits
+            self._condition.notify_all()
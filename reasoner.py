@@ -1,6 +1,6 @@
 import os
 import csv
-import json
+import orjson
 import logging
 import asyncio
 from pathlib import Path
@@ -148,8 +148,8 @@ async def main():
                     continue
                 
                 try:
-                    with open(description_file, 'r') as f:
-                        description_data = json.load(f)
+                    with open(description_file, 'rb') as f:
+                        description_data = orjson.loads(f.read())
                     
                     description_text = description_data.get("answer", "")
                     
@@ -179,8 +179,8 @@ async def main():
         # Remove video_id from the result before saving
         result_to_save = {k: v for k, v in result.items() if k != 'video_id'}
         
-        with open(output_path, 'w') as outf:
-            json.dump(result_to_save, outf, indent=2)
+        with open(output_path, 'wb') as outf:
+            outf.write(orjson.dumps(result_to_save, option=orjson.OPT_INDENT_2))
         
         logger.info(f"Completed reasoning for video ID: {video_id}")
 
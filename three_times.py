@@ -7,7 +7,7 @@ from openai import AsyncOpenAI
 from pathlib import Path
 import logging
 from typing import List, Dict
-import json
+import orjson
 from asyncio import Semaphore
 from dotenv import load_dotenv
 
@@ -220,8 +220,8 @@ async def main():
         
         # Save individual result immediately
         output_path = output_dir / f"{video_id}_result.json"
-        with open(output_path, 'w') as f:
-            json.dump(combined_result, f, indent=2)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(combined_result, option=orjson.OPT_INDENT_2))
         
         logger.info(f"Completed processing video ID: {video_id} (3 attempts)")
 